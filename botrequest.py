@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import asyncio
+from sys import stderr
+from time import monotonic
+from typing import Optional, TYPE_CHECKING, cast
+from importlib.util import find_spec
+
+from telegram.request import BaseRequest, HTTPXRequest, RequestData
+from telegram.error import TimedOut
+
+if TYPE_CHECKING:
+	# only for the signature of do_request; PTB doesn't export this type publicly
+	from telegram._utils.types import ODVInput
+
+from config import CONFIG
+
+
+def http2_available() -> bool:
+	'''
+	httpx only speaks HTTP/2 if the optional `h2` package is installed
+	'''
+	return find_spec('h2') is not None
+
+
+class PoolStats:
+	__slots__ = ('name', 'gated', 'requests', 'waited', 'total_wait', 'max_wait', 'timeouts')
+	name: str
+	# whether waits for a connection are measured at all
+	gated: bool
+	requests: int
+	waited: int
+	total_wait: float
+	max_wait: float
+	timeouts: int
+
+	def __init__(self, name: str, gated: bool):
+		self.name = name
+		self.gated = gated
+		self.requests = 0
+		self.waited = 0
+		self.total_wait = 0.0
+		self.max_wait = 0.0
+		self.timeouts = 0
+
+	def record(self, wait: float) -> None:
+		self.requests += 1
+		if wait > 0:
+			self.waited += 1
+			self.total_wait += wait
+			if wait > self.max_wait:
+				self.max_wait = wait
+
+	def summary(self) -> str:
+		if not self.gated:
+			return f'{self.name}: {self.requests} requests over HTTP/2, {self.timeouts} pool timeouts'
+		avg = self.total_wait / self.waited if self.waited else 0.0
+		return f'{self.name}: {self.requests} requests, {self.waited} waited for a connection ' \
+			f'(avg {avg * 1000:.1f}ms, max {self.max_wait * 1000:.1f}ms), {self.timeouts} pool timeouts'
+
+
+class InstrumentedRequest(HTTPXRequest):
+	'''
+	HTTPXRequest that measures how long each request waits for a free connection.
+
+	httpx doesn't tell us how long a request sat in its pool queue, so over HTTP/1.1 we gate requests
+	with a semaphore of the same size as the pool and time the acquisition instead.
+	httpx then always finds a free connection, and the pool timeout is enforced here.
+	Over HTTP/2 every connection carries many requests at once, so gating them per connection
+	would only hold them back; there, only httpx's pool timeouts are counted.
+	'''
+	_slots: Optional[asyncio.Semaphore]
+	_pool_timeout: Optional[float]
+	stats: PoolStats
+
+	def __init__(self, name: str, connection_pool_size: int):
+		http_version = CONFIG['http_version']
+		if http_version != '1.1' and not http2_available():
+			print(f'{name}: HTTP/2 requested but h2 is not installed, falling back to HTTP/1.1', file=stderr)
+			http_version = '1.1'
+		super().__init__(
+			connection_pool_size=connection_pool_size,
+			read_timeout=CONFIG['http_read_timeout'],
+			write_timeout=CONFIG['http_write_timeout'],
+			connect_timeout=CONFIG['http_connect_timeout'],
+			pool_timeout=CONFIG['http_pool_timeout'],
+			http_version=http_version,
+		)
+		self._slots = asyncio.Semaphore(connection_pool_size) if http_version == '1.1' else None
+		self._pool_timeout = CONFIG['http_pool_timeout']
+		self.stats = PoolStats(name, self._slots is not None)
+
+	async def do_request(
+		self,
+		url: str,
+		method: str,
+		request_data: Optional[RequestData] = None,
+		read_timeout: 'ODVInput[float]' = BaseRequest.DEFAULT_NONE,
+		write_timeout: 'ODVInput[float]' = BaseRequest.DEFAULT_NONE,
+		connect_timeout: 'ODVInput[float]' = BaseRequest.DEFAULT_NONE,
+		pool_timeout: 'ODVInput[float]' = BaseRequest.DEFAULT_NONE,
+	) -> tuple[int, bytes]:
+		if self._slots is None:
+			self.stats.record(0.0)
+		else:
+			# DEFAULT_NONE is the only default value PTB passes here
+			timeout = self._pool_timeout if pool_timeout is BaseRequest.DEFAULT_NONE else cast(Optional[float], pool_timeout)
+			await self.acquire_slot(self._slots, timeout)
+
+		try:
+			return await super().do_request(
+				url,
+				method,
+				request_data,
+				read_timeout,
+				write_timeout,
+				connect_timeout,
+				pool_timeout,
+			)
+		except TimedOut as e:
+			# over HTTP/2, httpx enforces the pool timeout itself
+			if self._slots is None and e.message.startswith('Pool timeout'):
+				self.stats.timeouts += 1
+				print(f'{self.stats.name}: timed out waiting for a connection', file=stderr)
+			raise
+		finally:
+			if self._slots is not None:
+				self._slots.release()
+
+	async def acquire_slot(self, slots: asyncio.Semaphore, timeout: Optional[float]) -> None:
+		contended = slots.locked()
+		start = monotonic()
+		try:
+			async with asyncio.timeout(timeout):
+				await slots.acquire()
+		except TimeoutError as e:
+			self.stats.timeouts += 1
+			print(f'{self.stats.name}: timed out after {monotonic() - start:.2f}s waiting for a connection', file=stderr)
+			raise TimedOut('Pool timeout: All connections in the connection pool are occupied.') from e
+		wait = monotonic() - start if contended else 0.0
+		self.stats.record(wait)
+		if contended and wait >= CONFIG['http_pool_wait_warn']:
+			print(f'{self.stats.name}: waited {wait:.2f}s for a connection from the pool', file=stderr)
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 from sys import stderr
+from time import monotonic
 from typing import Optional
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
 from hashlib import md5
 
 from telegram import Chat, Update, User, Message, Bot
-from telegram.constants import ParseMode
+from telegram.constants import ParseMode, BulkRequestLimit
 from telegram.helpers import escape_markdown
 from telegram.ext import CallbackContext
 from telegram.error import BadRequest, TelegramError
 
 import database
-from config import CONFIG
+from config import CONFIG, CHATS
 
-recent_messages: list[tuple[int, bytes, int]] = []
+# chat ID -> (message ID, number of messages cleared, time it was sent) of the last "cleared spam" notice
+spam_notices: dict[int, tuple[int, int, float]] = {}
 
 def escape_md(txt: str) -> str:
 	return escape_markdown(txt, 2)
@@ -24,33 +26,47 @@ def get_mention(user: User) -> str:
 def hashdigest(text: str) -> bytes:
 	return md5(text.encode('utf-8')).digest()
 
-def filter_chat(chat_id: int, chat: str) -> Callable[[Callable], Callable]:
+def filter_chat(function: Callable) -> Callable:
 	'''
-	chat_id: id of a chat
-	chat: chat handle
+	Only runs the handler in chats listed in the config
 	'''
-	def decorator(function: Callable) -> Callable:
-		async def wrapper(update: Update, context: CallbackContext) -> None:
-			if update.message is None:
-				return
-			if update.message.chat_id != chat_id:
-				await update.message.chat.send_message(
-					f'''This feature only works in chat @{escape_md(chat)}
+	async def wrapper(update: Update, context: CallbackContext) -> None:
+		if update.message is None:
+			return
+		if update.message.chat_id not in CHATS:
+			# chats that aren't public stay unnamed, so strangers can't find them through the bot
+			handles = [f"@{escape_md(chat['username'])}" for chat in CHATS.values() if chat['public']]
+			if handles:
+				where = f"chat{'s' if len(handles) > 1 else ''} {', '.join(handles)}"
+			else:
+				where = 'the chats this bot moderates'
+			await update.message.chat.send_message(
+				f'''This feature only works in {where}
 
 If you want to use this bot outside that group, please contact the developer: \
 [@RiedleroD](tg://user?id=388037461)''',
-					parse_mode=ParseMode.MARKDOWN_V2
-				)
-			else:
-				await function(update, context)
-		return wrapper
-	return decorator
+				parse_mode=ParseMode.MARKDOWN_V2
+			)
+		else:
+			await function(update, context)
+	return wrapper
 
 async def is_admin(chat: Chat, user: User) -> bool:
 	# might wanna cache admins
 	member = await chat.get_member(user.id)
 	return member.status in ('creator', 'administrator')
 
+async def mention_admins(chat: Chat) -> str:
+	'''
+	Mentions every human admin of the chat, so an alert actually notifies them
+	'''
+	try:
+		admins = await chat.get_administrators()
+	except TelegramError as e:
+		print(f"couldn't get the admins of {chat.id} ({e.message})", file=stderr)
+		return 'admins'
+	return ', '.join(get_mention(admin.user) for admin in admins if not admin.user.is_bot) or 'admins'
+
 
 async def get_reply_target(message: Message, sendback: Optional[str] = None) -> tuple[User, Message] | None:
 	'''
@@ -90,70 +106,120 @@ async def check_admin_to_user_action(message: Message, command: str, usable_on_b
 		return None
 	return tuser
 
-def remove_from_recent_messages(*args: int) -> None:
-	c = len(args)
-	# reverse iterate over list, so we can remove per-index without accounting for any offsets
-	for i in reversed(range(len(recent_messages))):
-		if recent_messages[i][0] in args:
-			recent_messages.pop(i)
-			c -= 1
+async def edit_or_send(
+	context: CallbackContext,
+	chatid: int,
+	msgid: Optional[int],
+	text: str,
+	reply_to: Optional[Message] = None
+) -> int:
+	'''
+	Edits the message `msgid` to say `text`, or sends a new one if there is none or it can't be edited.
+	Returns the ID of the message that now says `text`.
+	'''
+	if msgid is not None:
+		try:
+			await context.bot.edit_message_text(text, chatid, msgid, parse_mode=ParseMode.MARKDOWN_V2)
+			return msgid
+		except BadRequest as e:
+			if 'not modified' in e.message:
+				return msgid
+			print(f"couldn't edit message {msgid}: {e.message}", file=stderr)
+			# it's being replaced, so don't leave it lying around if it still exists
+			await delete_messages(context, chatid, [msgid])
+
+	msg: Optional[Message] = None
+	if reply_to is not None:
+		try:
+			msg = await reply_to.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+		except BadRequest as e:
+			# the message we wanted to reply to is probably gone already
+			print(f"couldn't reply to message {reply_to.message_id}: {e.message}", file=stderr)
+	if msg is None:
+		msg = await context.bot.send_message(chatid, text, parse_mode=ParseMode.MARKDOWN_V2)
+	return msg.message_id
+
+async def delete_messages(context: CallbackContext, chatid: int, msgids: Iterable[int]) -> None:
+	'''
+	Deletes messages in as few requests as possible
+	'''
+	ids = list(msgids)
+	for i in range(0, len(ids), BulkRequestLimit.MAX_LIMIT):
+		chunk = ids[i:i + BulkRequestLimit.MAX_LIMIT]
+		try:
+			await context.bot.delete_messages(chatid, chunk)
+		except BadRequest as e:
+			# we couldn't delete these messages; no biggie. There's lots of weird restrictions on what messages can be deleted.
+			print(f"couldn't delete messages {chunk}: {e.message}", file=stderr)
 
-			# found all messages to delete, exit loop
-			if c <= 0:
-				break
+async def notify_autofiltered(context: CallbackContext, chatid: int, autofiltered: int) -> None:
+	'''
+	Tells the chat how many spam messages were cleared.
+	Notices sent shortly after each other are merged into one.
+	'''
+	now = monotonic()
+	msgid, count, senttime = None, 0, now
+	if chatid in spam_notices:
+		lastid, lastcount, lastsent = spam_notices[chatid]
+		if now - lastsent < CONFIG['spam_notice_coalesce_seconds']:
+			msgid, count, senttime = lastid, lastcount, lastsent
+	count += autofiltered
+	plural = 's' if count >= 2 else ''
+	newid = await edit_or_send(context, chatid, msgid, escape_md(f"cleared {count} additional spam message{plural}"))
+	if newid != msgid:
+		# had to send a new notice, so that one starts a new window
+		senttime = now
+	spam_notices[chatid] = (newid, count, senttime)
 
 async def kick_message(
 	message: Message,
 	context: CallbackContext,
 	db: database.UserDB,
-	mark_as_spam: bool = False
+	mark_as_spam: bool = False,
+	fingerprint: bool = True,
+	purge_user: bool = False
 ) -> None:
 	'''
-	Removes a message, bans the user, and does all the necessary autofiltering stuff
+	Removes a message, bans the user, and does all the necessary autofiltering stuff.
+	With `fingerprint=False` the text isn't counted as spam, for kicks that aren't about what was said.
+	With `purge_user=True` the user's other recent messages are removed as well.
 	'''
 	assert message.from_user is not None
+	chatconf = CHATS[message.chat.id]
 	toban = set([message.from_user.id])
 	todel = set([message.id])
 
 	# immediately delete any messages associated with this votekick to unclog chat
-	todel.update(db.pop_vk_messages(message.from_user.id))
+	todel.update(db.pop_vk_messages(message.chat.id, message.from_user.id))
+	tally = db.pop_vk_tally(message.chat.id, message.from_user.id)
+	if tally is not None:
+		todel.add(tally)
+	if purge_user:
+		todel.update(db.pop_user_messages(message.chat.id, message.from_user.id))
 	# get rid of deleted messages in memory so we can remember more potentially important messages
-	remove_from_recent_messages(*todel)
+	db.forget_recent_messages(message.chat.id, todel)
 	try:
-		if message.text is not None and len(message.text) >= CONFIG['spam_minlength']:
+		if fingerprint and message.text is not None and len(message.text) >= chatconf['spam_minlength']:
 			thisdigest = hashdigest(message.text)
-			badness = db.check_message_badness(thisdigest)
-
-			if mark_as_spam:
-				badness += CONFIG['spam_threshhold']
-			else:
-				badness += 1
+			# badness is shared between chats, so spam caught in one chat is filtered in all of them
+			badness = db.add_message_badness(thisdigest, chatconf['spam_threshhold'] if mark_as_spam else 1)
 
 			autofiltered = 0
 			# autofiltering stuff
-			if badness >= CONFIG['spam_threshhold']:
-				for i in reversed(range(len(recent_messages))):
-					msgid, digest, userid = recent_messages[i]
-					if digest == thisdigest:
-						badness += 1
-						todel.add(msgid)
-						toban.add(userid)
-						del recent_messages[i]
-						autofiltered += 1
-
-			db.set_message_badness(thisdigest, badness)
+			if badness >= chatconf['spam_threshhold']:
+				for msgid, userid in db.pop_recent_messages(message.chat.id, thisdigest):
+					todel.add(msgid)
+					toban.add(userid)
+					autofiltered += 1
+
 			if autofiltered > 0:
-				plural = 's' if autofiltered >= 2 else ''
-				await context.bot.send_message(message.chat.id, f"cleared {autofiltered} additional spam message{plural}")
+				# every autofiltered copy makes the message a bit more certainly spam
+				db.add_message_badness(thisdigest, autofiltered)
+				await notify_autofiltered(context, message.chat.id, autofiltered)
 	finally:
 		for userid in toban:
 			await ban_user(context, message.chat.id, userid, message.sender_chat)
-		for msgid in todel:
-			try:
-				await context.bot.delete_message(message.chat.id, msgid)
-			except BadRequest as e:
-				# we couldn't delete this message; no biggie. There's lots of weird restrictions on what messages can be deleted.
-				print(f"couldn't delete message {userid}: {e.message}", file=stderr)
+		await delete_messages(context, message.chat.id, todel)
 
 async def ban_user(context: CallbackContext, chatid: int, userid: int, sender_chat: Chat | None) -> None:
 	pass # ban_chat_sender_chat
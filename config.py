@@ -2,30 +2,93 @@
 from os import path
 import sys
 import json
-from typing import TypedDict
+from typing import TypedDict, Required, Literal
+
+class ChatConfig(TypedDict, total=False):
+	'''
+	A chat the bot moderates. Settings that are left out fall back to the global ones.
+	'''
+	id: Required[int]
+	username: Required[str]
+	# whether the chat is named to people trying to use the bot elsewhere
+	public: bool
+	message_memory: int
+	spam_threshhold: int
+	spam_minlength: int
+	votes_required: int
+	flood_user_limit: None | int
+	flood_chat_limit: None | int
 
 class Config(TypedDict):
 	token: str
-	private_chat_id: int
-	private_chat_username: str
+	chats: list[ChatConfig]
+	state_backend: str
 	database_path: str
+	redis_url: str
+	redis_prefix: str
 	message_memory: int
 	spam_threshhold: int
 	spam_minlength: int
 	autodelete_every_seconds: None | int
 	votes_required: int
+	spam_notice_coalesce_seconds: float
+	flood_window_seconds: float
+	flood_buckets: int
+	flood_user_limit: None | int
+	flood_user_action: str
+	flood_chat_limit: None | int
+	connection_pool_size: int
+	get_updates_connection_pool_size: int
+	http_version: Literal['1.1', '2.0', '2']
+	http_read_timeout: float
+	http_write_timeout: float
+	http_connect_timeout: float
+	http_pool_timeout: float
+	http_pool_wait_warn: float
+	maintenance_every_seconds: None | int
+	backup_path: None | str
+	maintenance_pages_per_step: int
+	maintenance_pause_seconds: float
+	webhook_url: None | str
+	webhook_listen: str
+	webhook_port: int
+	webhook_secret: None | str
 
 
 defaultconfig: Config = {
 	'token': 'Your token goes here',
-	'private_chat_id': -1001218939335,
-	'private_chat_username': 'devs_chat',
+	'chats': [{'id': -1001218939335, 'username': 'devs_chat', 'public': True}],
+	'state_backend': 'sqlite',
 	'database_path': 'memebot.db',
+	'redis_url': 'redis://localhost:6379/0',
+	'redis_prefix': 'memebot:',
 	'message_memory': 100,
 	'spam_threshhold': 2,
 	'spam_minlength': 20,
 	'autodelete_every_seconds': None,
 	'votes_required': 3,
+	'spam_notice_coalesce_seconds': 300,
+	'flood_window_seconds': 10,
+	'flood_buckets': 10,
+	'flood_user_limit': 15,
+	'flood_user_action': 'alert',
+	'flood_chat_limit': None,
+	'connection_pool_size': 8,
+	'get_updates_connection_pool_size': 1,
+	'http_version': '2',
+	'http_read_timeout': 5.0,
+	'http_write_timeout': 5.0,
+	'http_connect_timeout': 5.0,
+	'http_pool_timeout': 1.0,
+	'http_pool_wait_warn': 0.1,
+	'maintenance_every_seconds': None,
+	'backup_path': None,
+	'maintenance_pages_per_step': 64,
+	'maintenance_pause_seconds': 0.05,
+	'webhook_url': None,
+	'webhook_listen': '0.0.0.0',
+	'webhook_port': 8443,
+	'webhook_secret': None,
 }
 
 print("reading config")
@@ -40,9 +103,32 @@ if not path.exists(CONFPATH):
 with open(CONFPATH) as f:
 	CONFIG: Config = json.load(f)
 
+# configs from before multi-chat support only name a single chat
+if 'chats' not in CONFIG.keys() and 'private_chat_id' in CONFIG.keys():
+	CONFIG['chats'] = [{
+		'id': CONFIG['private_chat_id'],  # type: ignore[typeddict-item]
+		'username': CONFIG['private_chat_username'],  # type: ignore[typeddict-item]
+		'public': True,
+	}]
+	print(f"  migrating private_chat_id={CONFIG['chats'][0]['id']} to chats")
+
 for k, v in defaultconfig.items():
 	if k not in CONFIG.keys():
 		CONFIG[k] = v  # type: ignore[literal-required]
 		print(f"  defaulting to {k}={v}")
 
+if not CONFIG['chats']:
+	raise Exception(f"no chats configured, add at least one to chats in {CONFPATH}")
+
 CONFIG['database_path'] = path.join(CURDIR, CONFIG['database_path'])
+if CONFIG['backup_path'] is not None:
+	CONFIG['backup_path'] = path.join(CURDIR, CONFIG['backup_path'])
+
+# per-chat settings, with the global ones filled in where a chat doesn't override them
+CHATS: dict[int, ChatConfig] = {}
+for chat in CONFIG['chats']:
+	for k in ('message_memory', 'spam_threshhold', 'spam_minlength', 'votes_required', 'flood_user_limit', 'flood_chat_limit'):
+		if k not in chat.keys():
+			chat[k] = CONFIG[k]  # type: ignore[literal-required]
+	chat.setdefault('public', False)
+	CHATS[chat['id']] = chat
@@ -1,51 +1,251 @@
 import sqlite3
+from os import replace
+from time import sleep
 from threading import RLock
+from typing import Optional
+from abc import ABC, abstractmethod
+from collections.abc import Iterable
 
-DB_SCHEME_VERSION = 3
+DB_SCHEME_VERSION = 5
+# rows ANALYZE looks at per index, so optimize() never has to scan a whole table
+ANALYSIS_LIMIT = 400
 
 
-class UserDB:
+class UserDB(ABC):
+	'''
+	Everything the bot needs to remember: users, warns, votekicks, known spam
+	and the window of recently seen messages that spam gets matched against.
+	'''
+	# whether backup, optimize and incremental_vacuum do anything
+	maintainable: bool = False
+
+	@abstractmethod
+	def get_warns(self, chatid: int, userid: int) -> int: ...
+
+	@abstractmethod
+	def set_warns(self, chatid: int, userid: int, warncount: int): ...
+
+	@abstractmethod
+	def set_trusted(self, userid: int, trusted: bool): ...
+
+	@abstractmethod
+	def get_trusted(self, userid: int) -> bool: ...
+
+	@abstractmethod
+	def add_vk_messages(self, chatid: int, bad_user: int, msg_ids: list[int]): ...
+
+	@abstractmethod
+	def cleanup_votekicks(self): ...
+
+	@abstractmethod
+	def pop_expired_messages(self) -> dict[int, list[int]]: ...
+
+	@abstractmethod
+	def pop_vk_messages(self, chatid: int, bad_user: int) -> list[int]: ...
+
+	@abstractmethod
+	def get_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]:
+		'''
+		Returns the ID of the message showing the votes against `bad_user`, if there is one
+		'''
+
+	@abstractmethod
+	def set_vk_tally(self, chatid: int, bad_user: int, msg_id: int): ...
+
+	@abstractmethod
+	def pop_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]: ...
+
+	@abstractmethod
+	def add_votekick(self, chatid: int, voter: int, bad_user: int): ...
+
+	@abstractmethod
+	def get_votekicks(self, chatid: int, bad_user: int) -> list[int]: ...
+
+	@abstractmethod
+	def increment_vkscore(self, userid: int): ...
+
+	@abstractmethod
+	def get_vkscore(self, userid: int) -> int:
+		'''
+		Returns 0 for users that never took part in a votekick
+		'''
+
+	@abstractmethod
+	def get_all_vkscores(self) -> dict[int, int]: ...
+
+	@abstractmethod
+	def check_message_badness(self, hashdigest: bytes) -> int: ...
+
+	@abstractmethod
+	def add_message_badness(self, hashdigest: bytes, amount: int) -> int:
+		'''
+		Atomically adds `amount` to the badness of a message and returns the new badness
+		'''
+
+	@abstractmethod
+	def remember_message(self, chatid: int, msg_id: int, hashdigest: bytes, userid: int, limit: int):
+		'''
+		Adds a message to the chat's recent messages, forgetting the oldest ones beyond `limit`
+		'''
+
+	@abstractmethod
+	def pop_recent_messages(self, chatid: int, hashdigest: bytes) -> list[tuple[int, int]]:
+		'''
+		Returns (message ID, user ID) of every recent message in the chat with this digest
+		and forgets them
+		'''
+
+	@abstractmethod
+	def pop_user_messages(self, chatid: int, userid: int) -> list[int]:
+		'''
+		Returns the IDs of every recent message `userid` sent in the chat and forgets them
+		'''
+
+	@abstractmethod
+	def forget_recent_messages(self, chatid: int, msg_ids: Iterable[int]): ...
+
+	def backup(self, dest_path: str, pages: int, pause: float):
+		'''
+		Backends that manage their own storage can leave the maintenance methods as no-ops
+		and `maintainable` unset
+		'''
+
+	def optimize(self):
+		pass
+
+	def incremental_vacuum(self, pages: int, pause: float):
+		pass
+
+
+class SQLiteDB(UserDB):
+	'''
+	Stores everything in a local SQLite file, and the recent messages in memory
+	'''
+	maintainable = True
 	mutex: RLock
 	db: sqlite3.Connection
+	recent_messages: dict[int, list[tuple[int, bytes, int]]]
 
-	def __init__(self, db_path: str):
+	def __init__(self, db_path: str, legacy_chat_id: int):
+		'''
+		legacy_chat_id: chat that votekicks and warns from before multi-chat support belong to
+		'''
 		self.mutex = RLock()
-		self.open(db_path)
+		self.recent_messages = {}
+		self.open(db_path, legacy_chat_id)
 
-	def open(self, db_path: str):
+	def open(self, db_path: str, legacy_chat_id: int):
 		self.db = sqlite3.connect(db_path, check_same_thread=False)
+		# only takes effect on new databases; existing ones get converted by the v5 upgrade below
+		self.db.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
+
+		# sqlite3 would commit the DDL statements on its own; run the whole upgrade in one
+		# transaction instead, so a failure leaves the database exactly as it was
+		isolation_level = self.db.isolation_level
+		self.db.isolation_level = None
+		self.db.execute('''BEGIN''')
+		try:
+			user_version = self.create_tables(legacy_chat_id)
+			self.db.execute('''COMMIT''')
+		except BaseException:
+			self.db.execute('''ROLLBACK''')
+			raise
+		finally:
+			self.db.isolation_level = isolation_level
+
+		if 0 < user_version < 5:
+			print("upgrading DB to: v5 (this may take a moment)")
+			# switching to incremental auto_vacuum needs one full VACUUM, which can't run in a transaction
+			self.db.execute('''VACUUM''')
+			self.db.execute(f'''PRAGMA user_version = {DB_SCHEME_VERSION}''')
+			self.db.commit()
+
+	def create_tables(self, legacy_chat_id: int) -> int:
+		'''
+		Creates missing tables and upgrades old ones. Returns the version the database had before.
+		'''
 		self.db.execute('''CREATE TABLE IF NOT EXISTS users(
 							userid INTEGER PRIMARY KEY UNIQUE,
 							warncount INTEGER CHECK(warncount >= 0),
 							trusted INTEGER CHECK(trusted >= 0 AND trusted <= 1),
 							vkscore INTEGER CHECK(vkscore >= 0)
 						)''')
+		c = self.db.execute('''PRAGMA user_version''')
+		user_version = c.fetchone()[0]
+
+		if 0 < user_version < 4:
+			print("upgrading DB to: v4")
+			# databases from before votekicks existed don't have these tables yet
+			self.db.execute('''CREATE TABLE IF NOT EXISTS votekicks(
+								voter INTEGER,
+								bad_user INTEGER,
+								timeout REAL,
+								PRIMARY KEY (voter,bad_user)
+							)''')
+			self.db.execute('''CREATE TABLE IF NOT EXISTS vk_messages(
+								bad_user INTEGER,
+								msg_id INTEGER
+							)''')
+			self.db.execute('''ALTER TABLE votekicks RENAME TO votekicks_v3''')
+			self.db.execute('''ALTER TABLE vk_messages RENAME TO vk_messages_v3''')
+
 		self.db.execute('''CREATE TABLE IF NOT EXISTS votekicks(
+							chatid INTEGER,
 							voter INTEGER,
 							bad_user INTEGER,
 							timeout REAL,
-							PRIMARY KEY (voter,bad_user)
+							PRIMARY KEY (chatid,voter,bad_user)
 						)''')
 		self.db.execute('''CREATE TABLE IF NOT EXISTS vk_messages(
+							chatid INTEGER,
 							bad_user INTEGER,
 							msg_id INTEGER
 						)''')
+		self.db.execute('''CREATE TABLE IF NOT EXISTS vk_tallies(
+							chatid INTEGER,
+							bad_user INTEGER,
+							msg_id INTEGER,
+							PRIMARY KEY (chatid,bad_user)
+						)''')
+		self.db.execute('''CREATE TABLE IF NOT EXISTS warns(
+							chatid INTEGER,
+							userid INTEGER,
+							warncount INTEGER CHECK(warncount >= 0),
+							PRIMARY KEY (chatid,userid)
+						)''')
 		self.db.execute('''CREATE TABLE IF NOT EXISTS badmessages(
 							hash BLOB PRIMARY KEY UNIQUE,
 							badness INTEGER CHECK(badness >= 0)
 						)''')
 
-		c = self.db.execute('''PRAGMA user_version''')
-		user_version = c.fetchone()[0]
-
 		if user_version > 0:
 			if user_version < 2:
 				print("upgrading DB to: v2")
 				self.db.execute('''ALTER TABLE users ADD COLUMN vkscore INTEGER DEFAULT 0 CHECK(vkscore >= 0)''')
+			if user_version < 4:
+				# everything before v4 belonged to the one chat the bot used to be limited to
+				self.db.execute(
+					'''INSERT INTO votekicks SELECT ?, voter, bad_user, timeout FROM votekicks_v3''',
+					(legacy_chat_id,)
+				)
+				self.db.execute(
+					'''INSERT INTO vk_messages SELECT ?, bad_user, msg_id FROM vk_messages_v3''',
+					(legacy_chat_id,)
+				)
+				self.db.execute(
+					'''INSERT INTO warns SELECT ?, userid, warncount FROM users WHERE warncount > 0''',
+					(legacy_chat_id,)
+				)
+				self.db.execute('''DROP TABLE votekicks_v3''')
+				self.db.execute('''DROP TABLE vk_messages_v3''')
 
-		self.db.execute(f'''PRAGMA user_version = {DB_SCHEME_VERSION}''')
+		if 0 < user_version < 5:
+			# v5 is only reached once the VACUUM in open() went through
+			self.db.execute('''PRAGMA user_version = 4''')
+		else:
+			self.db.execute(f'''PRAGMA user_version = {DB_SCHEME_VERSION}''')
 
-		self.db.commit()
+		return user_version
 
 	def create_user_row(self, userid: int, warncount: int = 0, trusted: bool = False):
 		with self.mutex:
@@ -60,22 +260,24 @@ class UserDB:
 			if fetch is None:
 				self.create_user_row(userid)
 
-	def get_warns(self, userid: int) -> int:
+	def get_warns(self, chatid: int, userid: int) -> int:
 		'''
-		Get user's warns. Create user row if user was not captured
+		Get user's warns in the chat with ID `chatid`
 		'''
-		self.ensure_user(userid)
 		with self.mutex:
 			c = self.db.cursor()
-			c.execute('''SELECT warncount FROM users WHERE userid = ?''', (userid,))
-			return c.fetchone()[0]
+			c.execute('''SELECT warncount FROM warns WHERE chatid = ? AND userid = ?''', (chatid, userid))
+			res = c.fetchone()
+			if res is None:
+				return 0
+			else:
+				return res[0]
 
-	def set_warns(self, userid: int, warncount: int):
-		self.ensure_user(userid)
+	def set_warns(self, chatid: int, userid: int, warncount: int):
 		with self.mutex:
 			self.db.execute(
-				'''UPDATE users SET warncount = ? WHERE userid = ?''',
-				(warncount, userid)
+				'''INSERT OR REPLACE INTO warns VALUES (?, ?, ?)''',
+				(chatid, userid, warncount)
 			)
 			self.db.commit()
 
@@ -92,16 +294,16 @@ class UserDB:
 			c.execute('''SELECT trusted FROM users WHERE userid = ?''', (userid,))
 			return bool(c.fetchone()[0])
 
-	def add_vk_messages(self, bad_user: int, msg_ids: list[int]):
+	def add_vk_messages(self, chatid: int, bad_user: int, msg_ids: list[int]):
 		'''
 		Adds `msg_ids` to the list of messages associated
-		with `bad_user`'s votekick.
+		with `bad_user`'s votekick in the chat with ID `chatid`.
 		'''
 		with self.mutex:
 			for msg_id in msg_ids:
 				self.db.execute(
-					'''INSERT INTO vk_messages VALUES (?, ?)''',
-					(bad_user, msg_id)
+					'''INSERT INTO vk_messages VALUES (?, ?, ?)''',
+					(chatid, bad_user, msg_id)
 				)
 			self.db.commit()
 
@@ -115,61 +317,92 @@ class UserDB:
 			c.fetchall()
 			self.db.commit()
 
-	def pop_expired_messages(self) -> list[int]:
+	def pop_expired_messages(self) -> dict[int, list[int]]:
 		'''
-		Returns the list of messages to be deleted
+		Returns the messages and tallies of expired votekicks, grouped by chat ID,
 		and removes them from the database
 		'''
 		with self.mutex:
 			c = self.db.cursor()
-			c.execute('''
-				SELECT msg_id FROM vk_messages
-				WHERE bad_user NOT IN (
-					SELECT bad_user FROM votekicks
-				);''')
-			msgs = [row[0] for row in c.fetchall()]
-			c.execute('''
-				DELETE FROM vk_messages
-				WHERE bad_user NOT IN (
-					SELECT bad_user FROM votekicks
-				);''')
-			c.fetchall()
+			msgs: dict[int, list[int]] = {}
+			for table in ('vk_messages', 'vk_tallies'):
+				c.execute(f'''
+					SELECT chatid, msg_id FROM {table}
+					WHERE (chatid, bad_user) NOT IN (
+						SELECT chatid, bad_user FROM votekicks
+					);''')
+				for chatid, msg_id in c.fetchall():
+					msgs.setdefault(chatid, []).append(msg_id)
+				c.execute(f'''
+					DELETE FROM {table}
+					WHERE (chatid, bad_user) NOT IN (
+						SELECT chatid, bad_user FROM votekicks
+					);''')
+				c.fetchall()
 			self.db.commit()
 			return msgs
 
-	def pop_vk_messages(self, bad_user: int) -> list[int]:
+	def pop_vk_messages(self, chatid: int, bad_user: int) -> list[int]:
 		'''
 		Returns the list of messages associated with the votekick for the user with ID `bad_user`
-		and removes them from the database
+		in the chat with ID `chatid` and removes them from the database
 		'''
 		with self.mutex:
 			c = self.db.cursor()
 			c.execute(
-				'''SELECT msg_id FROM vk_messages WHERE bad_user=?''',
-				(bad_user, )
+				'''SELECT msg_id FROM vk_messages WHERE chatid=? AND bad_user=?''',
+				(chatid, bad_user)
 			)
 			msgs = [row[0] for row in c.fetchall()]
 			c.execute(
-				'''DELETE FROM vk_messages WHERE bad_user=?''',
-				(bad_user, )
+				'''DELETE FROM vk_messages WHERE chatid=? AND bad_user=?''',
+				(chatid, bad_user)
 			)
 			self.db.commit()
 			return msgs
 
-	def add_votekick(self, voter: int, bad_user: int):
+	def get_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]:
+		with self.mutex:
+			c = self.db.execute(
+				'''SELECT msg_id FROM vk_tallies WHERE chatid=? AND bad_user=?''',
+				(chatid, bad_user)
+			)
+			res = c.fetchone()
+			if res is None:
+				return None
+			else:
+				return res[0]
+
+	def set_vk_tally(self, chatid: int, bad_user: int, msg_id: int):
+		with self.mutex:
+			self.db.execute('''INSERT OR REPLACE INTO vk_tallies VALUES (?, ?, ?)''', (chatid, bad_user, msg_id))
+			self.db.commit()
+
+	def pop_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]:
+		'''
+		Returns the tally message of `bad_user`'s votekick, if there is one,
+		and removes it from the database
+		'''
+		with self.mutex:
+			msg_id = self.get_vk_tally(chatid, bad_user)
+			self.db.execute('''DELETE FROM vk_tallies WHERE chatid=? AND bad_user=?''', (chatid, bad_user))
+			self.db.commit()
+			return msg_id
+
+	def add_votekick(self, chatid: int, voter: int, bad_user: int):
 		self.cleanup_votekicks()
 		with self.mutex:
 			self.db.execute(
-				'''INSERT OR IGNORE INTO votekicks VALUES (?, ?, JULIANDAY('NOW','+24 hours'))''',
-				(voter, bad_user)
+				'''INSERT OR IGNORE INTO votekicks VALUES (?, ?, ?, JULIANDAY('NOW','+24 hours'))''',
+				(chatid, voter, bad_user)
 			)
 			self.db.commit()
 
-	def get_votekicks(self, bad_user: int) -> list[int]:
+	def get_votekicks(self, chatid: int, bad_user: int) -> list[int]:
 		self.cleanup_votekicks()
 		with self.mutex:
 			c = self.db.cursor()
-			c.execute('''SELECT voter FROM votekicks WHERE bad_user=?''', (bad_user,))
+			c.execute('''SELECT voter FROM votekicks WHERE chatid=? AND bad_user=?''', (chatid, bad_user))
 			return [row[0] for row in c.fetchall()]
 
 	def increment_vkscore(self, userid: int):
@@ -180,6 +413,7 @@ class UserDB:
 			self.db.commit()
 
 	def get_vkscore(self, userid: int) -> int:
+		self.ensure_user(userid)
 		with self.mutex:
 			c = self.db.execute('''SELECT vkscore FROM users WHERE userid = ?''', (userid,))
 			return c.fetchone()[0]
@@ -198,8 +432,105 @@ class UserDB:
 			else:
 				return res[0]
 
-	def set_message_badness(self, hashdigest: bytes, badness: int):
+	def add_message_badness(self, hashdigest: bytes, amount: int) -> int:
 		with self.mutex:
-			c = self.db.cursor()
-			c.execute('''INSERT OR REPLACE INTO badmessages VALUES (?, ?)''', (hashdigest, badness))
+			self.db.execute(
+				'''INSERT INTO badmessages VALUES (?, ?)
+				ON CONFLICT(hash) DO UPDATE SET badness = badness + excluded.badness''',
+				(hashdigest, amount)
+			)
+			self.db.commit()
+			return self.check_message_badness(hashdigest)
+
+	def remember_message(self, chatid: int, msg_id: int, hashdigest: bytes, userid: int, limit: int):
+		messages = self.recent_messages.setdefault(chatid, [])
+		messages.append((msg_id, hashdigest, userid))
+		if len(messages) > limit:
+			del messages[:-limit]
+
+	def pop_recent_messages(self, chatid: int, hashdigest: bytes) -> list[tuple[int, int]]:
+		messages = self.recent_messages.get(chatid, [])
+		found = []
+		for i in reversed(range(len(messages))):
+			msg_id, digest, userid = messages[i]
+			if digest == hashdigest:
+				found.append((msg_id, userid))
+				del messages[i]
+		return found
+
+	def pop_user_messages(self, chatid: int, userid: int) -> list[int]:
+		messages = self.recent_messages.get(chatid, [])
+		found = []
+		for i in reversed(range(len(messages))):
+			msg_id, _digest, sender = messages[i]
+			if sender == userid:
+				found.append(msg_id)
+				del messages[i]
+		return found
+
+	def forget_recent_messages(self, chatid: int, msg_ids: Iterable[int]):
+		messages = self.recent_messages.get(chatid, [])
+		toforget = set(msg_ids)
+		c = len(toforget)
+		# reverse iterate over list, so we can remove per-index without accounting for any offsets
+		for i in reversed(range(len(messages))):
+			if messages[i][0] in toforget:
+				messages.pop(i)
+				c -= 1
+
+				# found all messages to delete, exit loop
+				if c <= 0:
+					break
+
+	def backup(self, dest_path: str, pages: int, pause: float):
+		'''
+		Copies the database to `dest_path` using SQLite's online backup API.
+		Copies `pages` pages at a time and releases the mutex for `pause` seconds between steps,
+		so handlers can keep using the database while the backup runs.
+		Writes made through this connection during the backup end up in the copy.
+		'''
+		def progress(_status: int, _remaining: int, _total: int):
+			self.mutex.release()
+			try:
+				sleep(pause)
+			finally:
+				self.mutex.acquire()
+
+		# write to a temporary file first, so a crash never leaves a half-written backup behind
+		tmp_path = dest_path + '.tmp'
+		dest = sqlite3.connect(tmp_path)
+		try:
+			with self.mutex:
+				self.db.backup(dest, pages=pages, progress=progress)
+		finally:
+			dest.close()
+		replace(tmp_path, dest_path)
+
+	def optimize(self):
+		'''
+		Refreshes the query planner statistics where they're out of date
+		'''
+		with self.mutex:
+			self.db.execute(f'''PRAGMA analysis_limit = {ANALYSIS_LIMIT}''')
+			self.db.execute('''PRAGMA optimize''')
 			self.db.commit()
+
+	def incremental_vacuum(self, pages: int, pause: float):
+		'''
+		Returns free pages to the file system, `pages` pages at a time,
+		releasing the mutex for `pause` seconds between steps
+		'''
+		with self.mutex:
+			c = self.db.execute('''PRAGMA auto_vacuum''')
+			if c.fetchone()[0] != 2:
+				# incremental_vacuum is a no-op unless auto_vacuum is INCREMENTAL
+				return
+		while True:
+			with self.mutex:
+				c = self.db.execute('''PRAGMA freelist_count''')
+				if c.fetchone()[0] == 0:
+					return
+				c = self.db.execute(f'''PRAGMA incremental_vacuum({int(pages)})''')
+				c.fetchall()
+				self.db.commit()
+			sleep(pause)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+from array import array
+from collections.abc import Hashable
+
+
+class RateCounter:
+	__slots__ = ('bucket', 'total', 'counts')
+	bucket: int
+	total: int
+	counts: array
+
+	def __init__(self, bucket: int, buckets: int):
+		self.bucket = bucket
+		self.total = 0
+		self.counts = array('I', [0]) * buckets
+
+
+class SlidingWindow:
+	'''
+	Counts events per key over the last `window` seconds.
+
+	The window is split into `buckets` slices, so each key only costs a handful of integers,
+	and counting an event is a few dict and array operations.
+	Keys that saw no events for a whole window are forgotten.
+	'''
+	__slots__ = ('bucket_len', 'buckets', 'counters')
+	bucket_len: float
+	buckets: int
+	# ordered from least to most recently used, so idle keys collect at the front
+	counters: dict[Hashable, RateCounter]
+
+	def __init__(self, window: float, buckets: int):
+		self.bucket_len = window / buckets
+		self.buckets = buckets
+		self.counters = {}
+
+	def hit(self, key: Hashable, timestamp: float) -> int:
+		'''
+		Counts an event for `key` and returns how many events it had within the window
+		'''
+		bucket = int(timestamp / self.bucket_len)
+		counter = self.counters.pop(key, None)
+		if counter is None:
+			counter = RateCounter(bucket, self.buckets)
+		elif bucket > counter.bucket:
+			# clear the slices that fell out of the window since the last event
+			if bucket - counter.bucket >= self.buckets:
+				counter.counts = array('I', [0]) * self.buckets
+				counter.total = 0
+			else:
+				for b in range(counter.bucket + 1, bucket + 1):
+					i = b % self.buckets
+					counter.total -= counter.counts[i]
+					counter.counts[i] = 0
+			counter.bucket = bucket
+		# events arriving out of order are counted in the newest slice
+
+		counter.counts[counter.bucket % self.buckets] += 1
+		counter.total += 1
+		self.counters[key] = counter
+
+		self.evict(bucket)
+		return counter.total
+
+	def evict(self, bucket: int) -> None:
+		while self.counters:
+			key = next(iter(self.counters))
+			if bucket - self.counters[key].bucket < self.buckets:
+				break
+			del self.counters[key]
+
+	def __len__(self) -> int:
+		return len(self.counters)
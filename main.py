@@ -1,39 +1,89 @@
 #!/usr/bin/env python3
+import asyncio
+from sys import stderr
 from math import floor, log10
+from urllib.parse import urlparse
+from time import monotonic
 from datetime import datetime
 from collections.abc import Callable
 
-from telegram import Update
+from telegram import Update, Message
 from telegram.constants import ParseMode
 from telegram.ext import Application, CallbackContext, CommandHandler, MessageHandler, filters
 from telegram.error import TelegramError
 
 import database
-from config import CONFIG
-from common import escape_md, hashdigest, get_mention, filter_chat, is_admin, get_reply_target, \
-	check_admin_to_user_action, kick_message, Leaderboard
-import common
-
-private_chat_id = CONFIG['private_chat_id']
-private_chat_username = CONFIG['private_chat_username']
-
-print('loading/creating database')
-db = database.UserDB(CONFIG['database_path'])
+from config import CONFIG, CHATS
+from common import escape_md, hashdigest, get_mention, filter_chat, is_admin, mention_admins, get_reply_target, \
+	check_admin_to_user_action, kick_message, edit_or_send, delete_messages, Leaderboard
+from botrequest import InstrumentedRequest
+from flood import SlidingWindow
+
+db: database.UserDB
+if CONFIG['state_backend'] == 'redis':
+	print('connecting to redis')
+	from redisdb import RedisDB
+	db = RedisDB(CONFIG['redis_url'], CONFIG['redis_prefix'])
+else:
+	print('loading/creating database')
+	db = database.SQLiteDB(CONFIG['database_path'], CONFIG['chats'][0]['id'])
 
 print("initializing commands")
-application = Application.builder().token(CONFIG["token"]).build()
+# getUpdates gets its own pool so long-polling never holds up bans, deletions and replies
+api_request = InstrumentedRequest('api', CONFIG['connection_pool_size'])
+updates_request = InstrumentedRequest('getUpdates', CONFIG['get_updates_connection_pool_size'])
+application = Application.builder() \
+	.token(CONFIG["token"]) \
+	.request(api_request) \
+	.get_updates_request(updates_request) \
+	.build()
 
 async def delete_vk_messages(context: CallbackContext) -> None:
 	db.cleanup_votekicks()
-	msgs = db.pop_expired_messages()
-	if msgs:
-		await context.bot.delete_messages(private_chat_id, msgs)
+	for chatid, msgs in db.pop_expired_messages().items():
+		await delete_messages(context, chatid, msgs)
 
 if CONFIG['autodelete_every_seconds'] is not None:
 	if application.job_queue is None:
 		raise Exception("missing requirement: python-telegram-bot[job-queue]")
 	application.job_queue.run_repeating(delete_vk_messages, interval=CONFIG['autodelete_every_seconds'], first=0)
 
+# task name -> duration of its last run in seconds
+maintenance_timings: dict[str, float] = {}
+
+async def db_maintenance(_context: CallbackContext) -> None:
+	'''
+	Backs up the database and keeps it tidy. Runs in a worker thread,
+	since the database only holds its mutex for one small step at a time.
+	'''
+	pages = CONFIG['maintenance_pages_per_step']
+	pause = CONFIG['maintenance_pause_seconds']
+	tasks: list[tuple[str, Callable[[], None]]] = []
+	if CONFIG['backup_path'] is not None:
+		backup_path = CONFIG['backup_path']
+		tasks.append(('backup', lambda: db.backup(backup_path, pages, pause)))
+	tasks.append(('optimize', db.optimize))
+	tasks.append(('vacuum', lambda: db.incremental_vacuum(pages, pause)))
+
+	for name, task in tasks:
+		start = monotonic()
+		try:
+			await asyncio.to_thread(task)
+		except Exception as e:
+			print(f"database {name} failed: {e}", file=stderr)
+			continue
+		maintenance_timings[name] = monotonic() - start
+		print(f"database {name} took {maintenance_timings[name]:.2f}s")
+
+if CONFIG['maintenance_every_seconds'] is not None:
+	if not db.maintainable:
+		# reporting timings for work that never happened would only mislead /botstats
+		print(f"the {CONFIG['state_backend']} backend has no database maintenance, not scheduling it", file=stderr)
+	elif application.job_queue is None:
+		raise Exception("missing requirement: python-telegram-bot[job-queue]")
+	else:
+		application.job_queue.run_repeating(db_maintenance, interval=CONFIG['maintenance_every_seconds'], first=60)
+
 
 def on_command(name: str) -> Callable[[Callable], Callable]:
 	def add_it(func: Callable) -> Callable:
@@ -55,7 +105,7 @@ async def ping(update: Update, _context: CallbackContext) -> None:
 
 
 @on_message(filters.StatusUpdate.NEW_CHAT_MEMBERS)
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def new_chat_member(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	handles = ", ".join(get_mention(member) for member in update.message.new_chat_members)
@@ -72,7 +122,7 @@ Welcome to this chat\\! Please read the rules\\.
 
 @on_command("spamkick")
 @on_command("kickspam")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def spamkick(update: Update, context: CallbackContext) -> None:
 	assert update.message is not None
 	assert update.message.from_user is not None
@@ -81,7 +131,7 @@ async def spamkick(update: Update, context: CallbackContext) -> None:
 		return
 	assert update.message.reply_to_message is not None
 
-	for voterid in db.get_votekicks(target.id):
+	for voterid in db.get_votekicks(update.message.chat_id, target.id):
 		if voterid != update.message.from_user.id:
 			db.increment_vkscore(voterid)
 
@@ -90,15 +140,15 @@ async def spamkick(update: Update, context: CallbackContext) -> None:
 	await kick_message(update.message.reply_to_message, context, db, mark_as_spam=True)
 
 @on_command("warn")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def warn_member(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	target = await check_admin_to_user_action(update.message, 'warn')
 	if target is None:
 		return
 
-	warns = db.get_warns(target.id) + 1
-	db.set_warns(target.id, warns)
+	warns = db.get_warns(update.message.chat_id, target.id) + 1
+	db.set_warns(update.message.chat_id, target.id, warns)
 	await update.message.chat.send_message(
 		f'*{get_mention(target)}* recieved a warn\\! Now they have {warns} warns',
 		parse_mode=ParseMode.MARKDOWN_V2
@@ -106,17 +156,17 @@ async def warn_member(update: Update, _context: CallbackContext) -> None:
 
 
 @on_command("unwarn")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def unwarn_member(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	target = await check_admin_to_user_action(update.message, 'unwarn')
 	if target is None:
 		return
 
-	warns = db.get_warns(target.id)
+	warns = db.get_warns(update.message.chat_id, target.id)
 	if warns > 0:
 		warns -= 1
-	db.set_warns(target.id, warns)
+	db.set_warns(update.message.chat_id, target.id, warns)
 	reply = f'*{get_mention(target)}* has been a good hooman\\! '
 	if warns == 0:
 		reply += 'Now they don\'t have any warns'
@@ -126,14 +176,14 @@ async def unwarn_member(update: Update, _context: CallbackContext) -> None:
 
 
 @on_command("clearwarns")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def clear_member_warns(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	target = await check_admin_to_user_action(update.message, 'clearwarns')
 	if target is None:
 		return
 
-	db.set_warns(target.id, 0)
+	db.set_warns(update.message.chat_id, target.id, 0)
 	await update.message.chat.send_message(
 		f"*{get_mention(target)}*'s warns were cleared",
 		parse_mode=ParseMode.MARKDOWN_V2
@@ -141,7 +191,7 @@ async def clear_member_warns(update: Update, _context: CallbackContext) -> None:
 
 
 @on_command("warns")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def get_member_warns(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	assert update.message.from_user is not None
@@ -149,13 +199,13 @@ async def get_member_warns(update: Update, _context: CallbackContext) -> None:
 	if target is not None:
 		tuser, tmsg = target
 	if target is None or tuser.id == update.message.from_user.id:
-		warns = db.get_warns(update.message.from_user.id)
+		warns = db.get_warns(update.message.chat_id, update.message.from_user.id)
 		await update.message.reply_text(
 			f'You have {"no" if warns == 0 else warns} warns',
 			parse_mode=ParseMode.MARKDOWN_V2
 		)
 		return
-	warns = db.get_warns(tuser.id)
+	warns = db.get_warns(update.message.chat_id, tuser.id)
 	if tuser.is_bot and tmsg.sender_chat is None:
 		await update.message.reply_text("Bots don't have warns", parse_mode=ParseMode.MARKDOWN_V2)
 		return
@@ -167,7 +217,7 @@ async def get_member_warns(update: Update, _context: CallbackContext) -> None:
 
 
 @on_command("trust")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def add_trusted_user(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	target = await check_admin_to_user_action(update.message, 'trust')
@@ -195,7 +245,7 @@ async def add_trusted_user(update: Update, _context: CallbackContext) -> None:
 
 
 @on_command("untrust")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def del_trusted_user(update: Update, _context: CallbackContext) -> None:
 	assert update.message is not None
 	target = await check_admin_to_user_action(update.message, 'untrust')
@@ -224,7 +274,7 @@ async def del_trusted_user(update: Update, _context: CallbackContext) -> None:
 
 @on_command("votekick")
 @on_command("kickvote")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def votekick(update: Update, context: CallbackContext) -> None:
 	assert update.message is not None
 
@@ -265,20 +315,25 @@ async def votekick(update: Update, context: CallbackContext) -> None:
 			parse_mode=ParseMode.MARKDOWN_V2
 		)
 	else:
-		votes_required = CONFIG['votes_required']
+		votes_required = CHATS[chat.id]['votes_required']
 
-		db.add_votekick(voter.id, tuser.id)
-		votes = db.get_votekicks(tuser.id)
+		db.add_votekick(chat.id, voter.id, tuser.id)
+		votes = db.get_votekicks(chat.id, tuser.id)
 		votec = len(votes)
 		appendix = "\nthat constitutes a ban\\!" if votec >= votes_required else ""
-		reply = await update.message.reply_text(
+		# one tally per votekick, edited as votes come in
+		tally = await edit_or_send(
+			context,
+			chat.id,
+			db.get_vk_tally(chat.id, tuser.id),
 			f'User {get_mention(tuser)} now has {votec}/{votes_required} votes against them\\.{appendix}',
-			parse_mode=ParseMode.MARKDOWN_V2
+			reply_to=update.message.reply_to_message
 		)
-		
+		db.add_vk_messages(chat.id, tuser.id, [update.message.message_id])
+
 		if votec >= votes_required:
 			# don't remove the bot's final message
-			db.add_vk_messages(tuser.id, [update.message.message_id])
+			db.pop_vk_tally(chat.id, tuser.id)
 
 			await kick_message(update.message.reply_to_message, context, db)
 
@@ -286,14 +341,14 @@ async def votekick(update: Update, context: CallbackContext) -> None:
 			for userid in votes:
 				db.increment_vkscore(userid)
 		else:
-			db.add_vk_messages(tuser.id, [update.message.message_id, reply.message_id])
+			db.set_vk_tally(chat.id, tuser.id, tally)
 
 	# immediately delete instead of queueing deletion if config says so
 	if CONFIG['autodelete_every_seconds'] is None:
 		await delete_vk_messages(context)
 
 @on_command("leaderboard")
-@filter_chat(private_chat_id, private_chat_username)
+@filter_chat
 async def leaderboard(update: Update, context: CallbackContext) -> None:
 	assert update.message is not None
 
@@ -344,23 +399,99 @@ async def myrank(update: Update, context: CallbackContext) -> None:
 		text = f"You're rank {user.rank} with {user.score} successful votekicks"
 	await update.message.reply_text(text, ParseMode.MARKDOWN_V2)
 
+@on_command("botstats")
+async def botstats(update: Update, _context: CallbackContext) -> None:
+	assert update.message is not None
+	assert update.message.from_user is not None
+	if not await is_admin(update.message.chat, update.message.from_user):
+		await update.message.reply_text('You are not an admin', parse_mode=ParseMode.MARKDOWN_V2)
+		return
+
+	lines = [api_request.stats.summary(), updates_request.stats.summary()]
+	lines.extend(f'database {name}: last run took {duration:.2f}s' for name, duration in maintenance_timings.items())
+	await update.message.reply_text(escape_md('\n'.join(lines)), parse_mode=ParseMode.MARKDOWN_V2)
+
+user_rates = SlidingWindow(CONFIG['flood_window_seconds'], CONFIG['flood_buckets'])
+chat_rates = SlidingWindow(CONFIG['flood_window_seconds'], CONFIG['flood_buckets'])
+
+async def check_flood(message: Message, context: CallbackContext) -> bool:
+	'''
+	Counts the message towards its sender's and its chat's message rate.
+	Returns True if the message was removed for flooding.
+	'''
+	assert message.from_user is not None
+	if message.sender_chat is not None or message.from_user.id == 777000:
+		# channel posts and anonymous admins; banning their sender would ban the channel or the group itself
+		return False
+	chatconf = CHATS[message.chat_id]
+	timestamp = message.date.timestamp()
+	window = CONFIG['flood_window_seconds']
+
+	chat_limit = chatconf['flood_chat_limit']
+	# only react when a limit is crossed, not on every message beyond it
+	if chat_limit is not None and chat_rates.hit(message.chat_id, timestamp) == chat_limit + 1:
+		await message.chat.send_message(
+			f'⚠️ {await mention_admins(message.chat)}: ' +
+			escape_md(f'more than {chat_limit} messages in the last {window}s, this might be a raid'),
+			parse_mode=ParseMode.MARKDOWN_V2
+		)
+
+	user_limit = chatconf['flood_user_limit']
+	if user_limit is None:
+		return False
+	count = user_rates.hit((message.chat_id, message.from_user.id), timestamp)
+	if count <= user_limit:
+		return False
+	if CONFIG['flood_user_action'] == 'kick' and not (
+		db.get_trusted(message.from_user.id) or await is_admin(message.chat, message.from_user)
+	):
+		# flooding says nothing about the text, so keep it out of the shared spam fingerprints,
+		# but take the rest of the flood down with it, including messages that arrive after the ban
+		await kick_message(message, context, db, fingerprint=False, purge_user=True)
+		return True
+	if count == user_limit + 1:
+		await message.reply_text(
+			f'⚠️ {await mention_admins(message.chat)}: {get_mention(message.from_user)} sent more than {user_limit} messages '
+			f'in the last {escape_md(str(window))}s',
+			parse_mode=ParseMode.MARKDOWN_V2
+		)
+	return False
+
 @on_message(filters.TEXT)
 async def on_text_message(update: Update, context: CallbackContext) -> None:
 	if update.message is not None and update.message.text is not None:
+		if update.message.chat_id not in CHATS:
+			return
 		assert update.message.from_user is not None
+		if await check_flood(update.message, context):
+			return
+		chatconf = CHATS[update.message.chat_id]
 		thishash = hashdigest(update.message.text)
 		badness = db.check_message_badness(thishash)
-		if badness >= CONFIG['spam_threshhold']:
+		if badness >= chatconf['spam_threshhold']:
 			await kick_message(update.message, context, db)
 		else:
-			common.recent_messages.append((
+			db.remember_message(
+				update.message.chat_id,
 				update.message.id,
 				thishash,
-				update.message.from_user.id
-			))
-			if len(common.recent_messages) > CONFIG['message_memory']:
-				common.recent_messages = common.recent_messages[-CONFIG['message_memory']:]
+				update.message.from_user.id,
+				chatconf['message_memory']
+			)
 
-print("starting polling")
-application.run_polling()
+if CONFIG['webhook_url'] is not None:
+	# Telegram only allows one getUpdates poller per bot, so several instances need a webhook
+	print("starting webhook")
+	application.run_webhook(
+		listen=CONFIG['webhook_listen'],
+		port=CONFIG['webhook_port'],
+		url_path=urlparse(CONFIG['webhook_url']).path.lstrip('/'),
+		webhook_url=CONFIG['webhook_url'],
+		secret_token=CONFIG['webhook_secret'],
+	)
+else:
+	print("starting polling")
+	application.run_polling()
+print(api_request.stats.summary())
+print(updates_request.stats.summary())
 print("exiting")
@@ -0,0 +1,216 @@
+from time import time
+from typing import Optional, cast
+from struct import Struct
+from collections.abc import Iterable
+
+try:
+	import redis
+except ImportError as e:
+	raise Exception("missing requirement: redis") from e
+
+from database import UserDB
+
+VOTEKICK_TIMEOUT = 24 * 60 * 60
+# how often pop_expired_messages retries when other instances keep voting in the meantime
+EXPIRY_RETRIES = 5
+
+# recent messages are stored as message ID and user ID, followed by the text digest
+RECENT_ENTRY = Struct('>qq')
+
+
+class RedisDB(UserDB):
+	'''
+	Stores everything in redis, so several instances of the bot can share their state.
+	Commands are pipelined, so most methods take a single round trip to the server.
+	'''
+	r: redis.Redis
+	prefix: str
+
+	def __init__(self, url: str, prefix: str):
+		self.r = redis.Redis.from_url(url)
+		self.prefix = prefix
+
+	def key(self, *parts: int | str) -> str:
+		return self.prefix + ':'.join(str(part) for part in parts)
+
+	def get_warns(self, chatid: int, userid: int) -> int:
+		warns = self.r.hget(self.key('warns', chatid), str(userid))
+		return 0 if warns is None else int(warns)
+
+	def set_warns(self, chatid: int, userid: int, warncount: int):
+		self.r.hset(self.key('warns', chatid), str(userid), warncount)
+
+	def set_trusted(self, userid: int, trusted: bool):
+		if trusted:
+			self.r.sadd(self.key('trusted'), userid)
+		else:
+			self.r.srem(self.key('trusted'), userid)
+
+	def get_trusted(self, userid: int) -> bool:
+		return bool(self.r.sismember(self.key('trusted'), str(userid)))
+
+	def add_vk_messages(self, chatid: int, bad_user: int, msg_ids: list[int]):
+		if not msg_ids:
+			return
+		with self.r.pipeline() as pipe:
+			pipe.rpush(self.key('vk_messages', chatid, bad_user), *msg_ids)
+			# remember which votekicks have messages, so pop_expired_messages doesn't have to scan for them
+			pipe.sadd(self.key('vk_messages'), f'{chatid}:{bad_user}')
+			pipe.execute()
+
+	def cleanup_votekicks(self):
+		'''
+		Votekick keys expire on their own, and outdated votes are dropped whenever they're read
+		'''
+
+	def pop_expired_messages(self) -> dict[int, list[int]]:
+		for _ in range(EXPIRY_RETRIES):
+			try:
+				return self._pop_expired_messages()
+			except redis.WatchError:
+				# another instance voted while we were checking; try again with the new votes
+				continue
+		return {}
+
+	def _pop_expired_messages(self) -> dict[int, list[int]]:
+		votekicks = [
+			(int(chatid), int(bad_user))
+			for chatid, bad_user in (
+				member.split(b':') for member in cast(set[bytes], self.r.smembers(self.key('vk_messages')))
+			)
+		]
+		if not votekicks:
+			return {}
+
+		with self.r.pipeline() as pipe:
+			# any vote from here on aborts the deletion below, so a votekick
+			# that's still live never loses its messages
+			pipe.watch(*(self.key('votekicks', chatid, bad_user) for chatid, bad_user in votekicks))
+
+			now = time()
+			with self.r.pipeline(transaction=False) as check:
+				for chatid, bad_user in votekicks:
+					check.zcount(self.key('votekicks', chatid, bad_user), now, '+inf')
+				votecounts = check.execute()
+
+			expired = [votekick for votekick, votec in zip(votekicks, votecounts) if votec == 0]
+			if not expired:
+				pipe.unwatch()
+				return {}
+
+			pipe.multi()
+			for chatid, bad_user in expired:
+				pipe.lrange(self.key('vk_messages', chatid, bad_user), 0, -1)
+				pipe.getdel(self.key('vk_tally', chatid, bad_user))
+				pipe.delete(self.key('vk_messages', chatid, bad_user))
+				pipe.srem(self.key('vk_messages'), f'{chatid}:{bad_user}')
+			results = pipe.execute()
+
+		msgs: dict[int, list[int]] = {}
+		for (chatid, _bad_user), msg_ids, tally in zip(expired, results[::4], results[1::4]):
+			chatmsgs = msgs.setdefault(chatid, [])
+			chatmsgs.extend(int(msg_id) for msg_id in msg_ids)
+			if tally is not None:
+				chatmsgs.append(int(tally))
+		return msgs
+
+	def pop_vk_messages(self, chatid: int, bad_user: int) -> list[int]:
+		with self.r.pipeline() as pipe:
+			pipe.lrange(self.key('vk_messages', chatid, bad_user), 0, -1)
+			pipe.delete(self.key('vk_messages', chatid, bad_user))
+			pipe.srem(self.key('vk_messages'), f'{chatid}:{bad_user}')
+			msg_ids = pipe.execute()[0]
+		return [int(msg_id) for msg_id in msg_ids]
+
+	def get_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]:
+		msg_id = self.r.get(self.key('vk_tally', chatid, bad_user))
+		return None if msg_id is None else int(msg_id)
+
+	def set_vk_tally(self, chatid: int, bad_user: int, msg_id: int):
+		with self.r.pipeline() as pipe:
+			pipe.set(self.key('vk_tally', chatid, bad_user), msg_id)
+			pipe.sadd(self.key('vk_messages'), f'{chatid}:{bad_user}')
+			pipe.execute()
+
+	def pop_vk_tally(self, chatid: int, bad_user: int) -> Optional[int]:
+		msg_id = self.r.getdel(self.key('vk_tally', chatid, bad_user))
+		return None if msg_id is None else int(msg_id)
+
+	def add_votekick(self, chatid: int, voter: int, bad_user: int):
+		key = self.key('votekicks', chatid, bad_user)
+		with self.r.pipeline() as pipe:
+			# each vote is scored with its own timeout; the key outlives the newest vote
+			pipe.zadd(key, {str(voter): time() + VOTEKICK_TIMEOUT}, nx=True)
+			pipe.expire(key, VOTEKICK_TIMEOUT)
+			pipe.execute()
+
+	def get_votekicks(self, chatid: int, bad_user: int) -> list[int]:
+		key = self.key('votekicks', chatid, bad_user)
+		with self.r.pipeline() as pipe:
+			pipe.zremrangebyscore(key, '-inf', time())
+			pipe.zrange(key, 0, -1)
+			voters = pipe.execute()[1]
+		return [int(voter) for voter in voters]
+
+	def increment_vkscore(self, userid: int):
+		self.r.zincrby(self.key('vkscores'), 1, str(userid))
+
+	def get_vkscore(self, userid: int) -> int:
+		score = self.r.zscore(self.key('vkscores'), str(userid))
+		return 0 if score is None else int(score)
+
+	def get_all_vkscores(self) -> dict[int, int]:
+		scores = cast(list[tuple[bytes, float]], self.r.zrangebyscore(self.key('vkscores'), 1, '+inf', withscores=True))
+		return {int(userid): int(score) for userid, score in scores}
+
+	def check_message_badness(self, hashdigest: bytes) -> int:
+		badness = self.r.hget(self.key('badmessages'), hashdigest)
+		return 0 if badness is None else int(badness)
+
+	def add_message_badness(self, hashdigest: bytes, amount: int) -> int:
+		return int(self.r.hincrby(self.key('badmessages'), hashdigest, amount))
+
+	def remember_message(self, chatid: int, msg_id: int, hashdigest: bytes, userid: int, limit: int):
+		key = self.key('recent', chatid)
+		with self.r.pipeline() as pipe:
+			pipe.rpush(key, RECENT_ENTRY.pack(msg_id, userid) + hashdigest)
+			pipe.ltrim(key, -limit, -1)
+			pipe.execute()
+
+	def _remove_recent_entries(self, chatid: int, entries: list[bytes]):
+		if not entries:
+			return
+		with self.r.pipeline(transaction=False) as pipe:
+			for entry in entries:
+				# the stubs only allow str, but redis compares values as bytes either way
+				pipe.lrem(self.key('recent', chatid), 1, entry)  # type: ignore[arg-type]
+			pipe.execute()
+
+	def _recent_entries(self, chatid: int) -> list[bytes]:
+		return cast(list[bytes], self.r.lrange(self.key('recent', chatid), 0, -1))
+
+	def pop_recent_messages(self, chatid: int, hashdigest: bytes) -> list[tuple[int, int]]:
+		entries = [
+			entry for entry in self._recent_entries(chatid)
+			if entry[RECENT_ENTRY.size:] == hashdigest
+		]
+		self._remove_recent_entries(chatid, entries)
+		# another instance may have removed some of them in the meantime; banning twice is harmless
+		return [RECENT_ENTRY.unpack_from(entry) for entry in entries]
+
+	def pop_user_messages(self, chatid: int, userid: int) -> list[int]:
+		entries = [
+			entry for entry in self._recent_entries(chatid)
+			if RECENT_ENTRY.unpack_from(entry)[1] == userid
+		]
+		self._remove_recent_entries(chatid, entries)
+		return [RECENT_ENTRY.unpack_from(entry)[0] for entry in entries]
+
+	def forget_recent_messages(self, chatid: int, msg_ids: Iterable[int]):
+		toforget = set(msg_ids)
+		if not toforget:
+			return
+		self._remove_recent_entries(chatid, [
+			entry for entry in self._recent_entries(chatid)
+			if RECENT_ENTRY.unpack_from(entry)[0] in toforget
+		])
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+'''
+Replays an exported chat history through the bot's spam filtering offline,
+for every combination of the given settings at once.
+
+    python3 simulate.py result.json --events events.jsonl \\
+        --spam-threshhold 2 3 --spam-minlength 10 20 --message-memory 100 200 --votes-required 2 3
+
+`result.json` is a Telegram Desktop chat export (JSON). The events file has one JSON object per line:
+
+    {"type": "votekick", "date": 1700000000, "voter": 1234, "msg_id": 42}
+    {"type": "spamkick", "date": 1700000000, "msg_id": 42}
+    {"type": "spam", "msg_id": 42}
+
+"spam" only labels a message. Targets of /votekick and /spamkick count as spam as well.
+The bot's own commands are skipped, since they never reach its recent-message window.
+'''
+import json
+import argparse
+from sys import getsizeof
+from bisect import bisect_left, insort
+from datetime import datetime
+from itertools import product
+
+VOTEKICK_TIMEOUT = 24 * 60 * 60
+
+# the commands main.py registers; their CommandHandlers run before on_text_message, so they never reach the window
+BOT_COMMANDS = {
+	'ping', 'spamkick', 'kickspam', 'warn', 'unwarn', 'clearwarns', 'warns',
+	'trust', 'untrust', 'votekick', 'kickvote', 'leaderboard', 'myrank', 'botstats',
+}
+
+# what one remembered message costs in SQLiteDB.recent_messages: (message ID, md5 digest, user ID) plus the list slot
+ENTRY_BYTES = getsizeof((0, b'', 0)) + getsizeof(bytes(16)) + 2 * getsizeof(2**40) + 8
+
+
+class Stream:
+	'''
+	Everything about the replayed messages that doesn't depend on the settings,
+	indexed by the position of the message in the export
+	'''
+	__slots__ = ('msg_ids', 'digests', 'lengths', 'users', 'index', 'spam')
+	msg_ids: list[int]
+	# texts are interned to small ints, which stand in for their md5 digests
+	digests: list[int]
+	lengths: list[int]
+	users: list[int]
+	# message ID -> position
+	index: dict[int, int]
+	spam: set[int]
+
+	def __init__(self):
+		self.msg_ids = []
+		self.digests = []
+		self.lengths = []
+		self.users = []
+		self.index = {}
+		self.spam = set()
+
+
+class Combo:
+	'''
+	The state the bot would have with one combination of settings.
+
+	Instead of its own copy of recent_messages, each combo keeps a view into the shared stream:
+	everything from `frontier` on that isn't in `dead` is in its window.
+	'''
+	__slots__ = (
+		'spam_threshhold', 'spam_minlength', 'message_memory', 'votes_required',
+		'badness', 'dead', 'dead_sorted', 'frontier', 'seen', 'live', 'peak',
+		'banned', 'prevented', 'spamkicked', 'db_ops',
+	)
+	spam_threshhold: int
+	spam_minlength: int
+	message_memory: int
+	votes_required: int
+	badness: dict[int, int]
+	# positions of messages that were removed or never remembered
+	dead: set[int]
+	dead_sorted: list[int]
+	frontier: int
+	seen: int
+	live: int
+	peak: int
+	banned: set[int]
+	# messages from banned users, which would never have reached the bot
+	prevented: int
+	spamkicked: set[int]
+	db_ops: int
+
+	def __init__(self, spam_threshhold: int, spam_minlength: int, message_memory: int, votes_required: int):
+		self.spam_threshhold = spam_threshhold
+		self.spam_minlength = spam_minlength
+		self.message_memory = message_memory
+		self.votes_required = votes_required
+		self.badness = {}
+		self.dead = set()
+		self.dead_sorted = []
+		self.frontier = 0
+		self.seen = 0
+		self.live = 0
+		self.peak = 0
+		self.banned = set()
+		self.prevented = 0
+		self.spamkicked = set()
+		self.db_ops = 0
+
+	def dead_between(self, start: int, end: int) -> int:
+		return bisect_left(self.dead_sorted, end) - bisect_left(self.dead_sorted, start)
+
+	def catch_up(self, upto: int) -> None:
+		'''
+		Remembers every message up to position `upto` that wasn't handled since the last call,
+		and forgets the oldest ones beyond message_memory
+		'''
+		self.live += upto - self.seen
+		self.seen = upto
+		if self.live > self.message_memory:
+			# find where the window starts without walking it: skip exactly message_memory live entries back
+			start = upto - self.message_memory
+			while True:
+				newstart = upto - self.message_memory - self.dead_between(start, upto)
+				if newstart == start:
+					break
+				start = newstart
+			self.frontier = max(self.frontier, start)
+			self.live = self.message_memory
+		self.peak = max(self.peak, self.live)
+
+	def kill(self, pos: int) -> None:
+		if pos in self.dead:
+			return
+		if pos >= self.frontier and pos < self.seen:
+			self.live -= 1
+		self.dead.add(pos)
+		insort(self.dead_sorted, pos)
+
+
+class Simulation:
+	__slots__ = ('stream', 'combos', 'armed', 'banned', 'votes')
+	stream: Stream
+	combos: list[Combo]
+	# digest -> combos that would kick it on sight
+	armed: dict[int, list[Combo]]
+	# user ID -> combos that banned them
+	banned: dict[int, list[Combo]]
+	# user ID -> voter ID -> time the vote expires
+	votes: dict[int, dict[int, float]]
+
+	def __init__(self, combos: list[Combo]):
+		self.stream = Stream()
+		self.combos = combos
+		self.armed = {}
+		self.banned = {}
+		self.votes = {}
+
+	def kick_message(self, combo: Combo, pos: int, mark_as_spam: bool = False) -> None:
+		'''
+		What common.kick_message does to the bot's state
+		'''
+		s = self.stream
+		combo.catch_up(len(s.digests))
+		combo.kill(pos)
+		self.ban(combo, s.users[pos])
+		# pop_vk_messages, pop_vk_tally
+		combo.db_ops += 2
+		if s.lengths[pos] < combo.spam_minlength:
+			return
+
+		digest = s.digests[pos]
+		badness = combo.badness.get(digest, 0) + (combo.spam_threshhold if mark_as_spam else 1)
+		combo.db_ops += 1
+		if badness >= combo.spam_threshhold:
+			autofiltered = 0
+			for i in range(combo.frontier, combo.seen):
+				if s.digests[i] == digest and i not in combo.dead:
+					combo.kill(i)
+					self.ban(combo, s.users[i])
+					autofiltered += 1
+			if autofiltered > 0:
+				badness += autofiltered
+				combo.db_ops += 1
+			if combo.badness.get(digest, 0) < combo.spam_threshhold:
+				self.armed.setdefault(digest, []).append(combo)
+		combo.badness[digest] = badness
+
+	def ban(self, combo: Combo, userid: int) -> None:
+		if userid not in combo.banned:
+			combo.banned.add(userid)
+			self.banned.setdefault(userid, []).append(combo)
+
+	def on_text_message(self, msg_id: int, text: str, userid: int, digest: int) -> None:
+		s = self.stream
+		pos = len(s.digests)
+		s.msg_ids.append(msg_id)
+		s.digests.append(digest)
+		s.lengths.append(len(text))
+		s.users.append(userid)
+		s.index[msg_id] = pos
+
+		# for almost every message, no combo reacts and remembering it is just the append above
+		for combo in self.banned.get(userid, ()):
+			# a banned user couldn't have sent this
+			combo.catch_up(pos)
+			combo.kill(pos)
+			combo.seen = pos + 1
+			combo.prevented += 1
+		for combo in self.armed.get(digest, ()):
+			if userid not in combo.banned:
+				combo.catch_up(pos)
+				combo.kill(pos)
+				combo.seen = pos + 1
+				self.kick_message(combo, pos)
+
+	def on_votekick(self, date: float, voter: int, msg_id: int) -> None:
+		s = self.stream
+		if msg_id not in s.index:
+			return
+		pos = s.index[msg_id]
+		bad_user = s.users[pos]
+		votes = self.votes.setdefault(bad_user, {})
+		for v in [v for v, timeout in votes.items() if timeout < date]:
+			del votes[v]
+		votes.setdefault(voter, date + VOTEKICK_TIMEOUT)
+
+		for combo in self.combos:
+			if pos in combo.dead or bad_user in combo.banned:
+				# nobody can reply to a message that's already gone
+				continue
+			# get_trusted twice, add_votekick, get_votekicks, get_vk_tally, add_vk_messages, set_vk_tally/pop_vk_tally
+			combo.db_ops += 7
+			if len(votes) >= combo.votes_required:
+				combo.db_ops += len(votes)
+				self.kick_message(combo, pos)
+
+	def on_spamkick(self, msg_id: int) -> None:
+		s = self.stream
+		if msg_id not in s.index:
+			return
+		pos = s.index[msg_id]
+		bad_user = s.users[pos]
+		voters = len(self.votes.get(bad_user, ()))
+		for combo in self.combos:
+			if pos in combo.dead or bad_user in combo.banned:
+				continue
+			# get_votekicks, increment_vkscore for the voters and the admin
+			combo.db_ops += 2 + voters
+			combo.spamkicked.add(pos)
+			self.kick_message(combo, pos, mark_as_spam=True)
+
+	def report(self, combo: Combo) -> dict[str, int]:
+		s = self.stream
+		combo.catch_up(len(s.digests))
+		spam = {s.index[msg_id] for msg_id in s.spam if msg_id in s.index}
+		removed = combo.dead - combo.spamkicked
+		return {
+			'spam_threshhold': combo.spam_threshhold,
+			'spam_minlength': combo.spam_minlength,
+			'message_memory': combo.message_memory,
+			'votes_required': combo.votes_required,
+			'spam_caught': len(removed & spam),
+			'spam_missed': len(spam - removed),
+			'false_positives': len(removed - spam),
+			'window_peak': combo.peak,
+			'window_bytes': combo.peak * ENTRY_BYTES,
+			'badness_rows': len(combo.badness),
+			# check_message_badness for every message the bot got to see
+			'db_ops': combo.db_ops + len(s.digests) - combo.prevented,
+		}
+
+
+def export_text(text: str | list) -> str:
+	'''
+	Telegram exports formatted text as a list of plain strings and entity objects
+	'''
+	if isinstance(text, str):
+		return text
+	return ''.join(part if isinstance(part, str) else part['text'] for part in text)
+
+def export_user(from_id: str) -> int:
+	# "user1234" or "channel1234"
+	return int(from_id.lstrip('abcdefghijklmnopqrstuvwxyz'))
+
+def export_date(msg: dict) -> float:
+	# older exports only have the local time the chat was exported in
+	if 'date_unixtime' in msg:
+		return float(msg['date_unixtime'])
+	return datetime.fromisoformat(msg['date']).timestamp()
+
+def is_command(text: str) -> bool:
+	'''
+	Whether the bot handles the text as a command, e.g. "/votekick" or "/votekick@somebot"
+	'''
+	if not text.startswith('/'):
+		return False
+	command = text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+	return command.lower() in BOT_COMMANDS
+
+def load(export_path: str, events_path: str | None) -> list[tuple[float, int, dict]]:
+	'''
+	Returns messages and events ordered by time, messages first where they coincide
+	'''
+	with open(export_path) as f:
+		export = json.load(f)
+	timeline: list[tuple[float, int, dict]] = []
+	for msg in export['messages']:
+		if msg.get('type') != 'message' or 'from_id' not in msg:
+			continue
+		text = export_text(msg.get('text', ''))
+		if text and not is_command(text):
+			timeline.append((export_date(msg), 0, {
+				'msg_id': msg['id'],
+				'text': text,
+				'user': export_user(msg['from_id']),
+			}))
+	if events_path is not None:
+		with open(events_path) as f:
+			for line in f:
+				if line.strip():
+					event = json.loads(line)
+					timeline.append((float(event.get('date', 0)), 1, event))
+	timeline.sort(key=lambda item: (item[0], item[1]))
+	return timeline
+
+def simulate(timeline: list[tuple[float, int, dict]], combos: list[Combo]) -> list[dict[str, int]]:
+	sim = Simulation(combos)
+	texts: dict[str, int] = {}
+	for date, _kind, item in timeline:
+		if 'text' in item:
+			digest = texts.setdefault(item['text'], len(texts))
+			sim.on_text_message(item['msg_id'], item['text'], item['user'], digest)
+			continue
+		# labels may refer to messages that weren't replayed yet
+		sim.stream.spam.add(item['msg_id'])
+		if item['type'] == 'votekick':
+			sim.on_votekick(date, item['voter'], item['msg_id'])
+		elif item['type'] == 'spamkick':
+			sim.on_spamkick(item['msg_id'])
+	return [sim.report(combo) for combo in combos]
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('export', help='Telegram Desktop chat export (result.json)')
+	parser.add_argument('--events', help='moderation events and spam labels, one JSON object per line')
+	parser.add_argument('--spam-threshhold', type=int, nargs='+', default=[1, 2, 3, 4])
+	parser.add_argument('--spam-minlength', type=int, nargs='+', default=[10, 20, 40])
+	parser.add_argument('--message-memory', type=int, nargs='+', default=[50, 100, 200, 400])
+	parser.add_argument('--votes-required', type=int, nargs='+', default=[2, 3, 4])
+	parser.add_argument('--csv', action='store_true', help='print CSV instead of a table')
+	args = parser.parse_args()
+
+	combos = [
+		Combo(*params)
+		for params in product(args.spam_threshhold, args.spam_minlength, args.message_memory, args.votes_required)
+	]
+	results = simulate(load(args.export, args.events), combos)
+	# best first: fewest false positives, then most spam caught, then least memory
+	results.sort(key=lambda r: (r['false_positives'], -r['spam_caught'], r['window_bytes'], r['db_ops']))
+
+	columns = list(results[0].keys())
+	if args.csv:
+		print(','.join(columns))
+		for r in results:
+			print(','.join(str(r[c]) for c in columns))
+	else:
+		widths = [max(len(c), *(len(str(r[c])) for r in results)) for c in columns]
+		print('  '.join(c.rjust(w) for c, w in zip(columns, widths)))
+		for r in results:
+			print('  '.join(str(r[c]).rjust(w) for c, w in zip(columns, widths)))
+
+if __name__ == '__main__':
+	main()
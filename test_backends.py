@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+'''
+Checks that every state backend behaves the same. RedisDB runs against fakeredis,
+a local stand-in for a redis server, and is skipped if that isn't installed.
+
+    python3 -m unittest test_backends
+'''
+import unittest
+from unittest import mock
+
+from database import UserDB, SQLiteDB
+
+try:
+	import fakeredis
+	import redis
+except ImportError:
+	HAVE_FAKEREDIS = False
+else:
+	HAVE_FAKEREDIS = True
+	from redisdb import RedisDB
+
+CHAT = -100
+OTHER_CHAT = -200
+DIGEST = b'\x01' * 16
+
+
+class BackendTests:
+	db: UserDB
+
+	def test_warns_are_per_chat(self):
+		self.db.set_warns(CHAT, 5, 2)
+		self.assertEqual(self.db.get_warns(CHAT, 5), 2)
+		self.assertEqual(self.db.get_warns(OTHER_CHAT, 5), 0)
+
+	def test_trust(self):
+		self.db.set_trusted(5, True)
+		self.assertTrue(self.db.get_trusted(5))
+		self.assertFalse(self.db.get_trusted(6))
+		self.db.set_trusted(5, False)
+		self.assertFalse(self.db.get_trusted(5))
+
+	def test_votekicks_are_per_chat(self):
+		self.db.add_votekick(CHAT, 7, 9)
+		self.db.add_votekick(CHAT, 8, 9)
+		self.db.add_votekick(CHAT, 8, 9)
+		self.assertEqual(sorted(self.db.get_votekicks(CHAT, 9)), [7, 8])
+		self.assertEqual(self.db.get_votekicks(OTHER_CHAT, 9), [])
+
+	def test_expired_messages(self):
+		self.db.add_votekick(CHAT, 7, 9)
+		self.db.add_vk_messages(CHAT, 9, [1, 2])
+		self.db.set_vk_tally(CHAT, 9, 50)
+		# nobody voted against 10, so its votekick counts as expired
+		self.db.add_vk_messages(CHAT, 10, [3])
+		self.db.set_vk_tally(CHAT, 10, 51)
+		self.assertEqual({chat: sorted(msgs) for chat, msgs in self.db.pop_expired_messages().items()}, {CHAT: [3, 51]})
+		self.assertEqual(self.db.pop_expired_messages(), {})
+		self.assertEqual(self.db.get_vk_tally(CHAT, 9), 50)
+		self.assertEqual(self.db.pop_vk_messages(CHAT, 9), [1, 2])
+		self.assertEqual(self.db.pop_vk_messages(CHAT, 9), [])
+		self.assertEqual(self.db.pop_vk_tally(CHAT, 9), 50)
+		self.assertIsNone(self.db.pop_vk_tally(CHAT, 9))
+
+	def test_vkscores(self):
+		self.assertEqual(self.db.get_vkscore(7), 0)
+		self.db.increment_vkscore(7)
+		self.db.increment_vkscore(7)
+		self.assertEqual(self.db.get_vkscore(7), 2)
+		self.assertEqual(self.db.get_all_vkscores(), {7: 2})
+
+	def test_badness(self):
+		self.assertEqual(self.db.check_message_badness(DIGEST), 0)
+		self.assertEqual(self.db.add_message_badness(DIGEST, 2), 2)
+		self.assertEqual(self.db.add_message_badness(DIGEST, 1), 3)
+		self.assertEqual(self.db.check_message_badness(DIGEST), 3)
+
+	def test_recent_messages(self):
+		for i in range(5):
+			self.db.remember_message(CHAT, i, DIGEST if i % 2 else bytes(16), 100 + i, 4)
+		self.db.remember_message(OTHER_CHAT, 9, DIGEST, 109, 4)
+		self.db.forget_recent_messages(CHAT, [3])
+		# message 0 fell out of the window, 3 was forgotten
+		self.assertEqual(sorted(self.db.pop_recent_messages(CHAT, DIGEST)), [(1, 101)])
+		self.assertEqual(self.db.pop_recent_messages(CHAT, DIGEST), [])
+		self.assertEqual(self.db.pop_recent_messages(OTHER_CHAT, DIGEST), [(9, 109)])
+
+	def test_user_messages(self):
+		for i in range(5):
+			self.db.remember_message(CHAT, i, DIGEST, 100 + i % 2, 4)
+		self.db.remember_message(OTHER_CHAT, 9, DIGEST, 101, 4)
+		# message 0 fell out of the window
+		self.assertEqual(sorted(self.db.pop_user_messages(CHAT, 100)), [2, 4])
+		self.assertEqual(self.db.pop_user_messages(CHAT, 100), [])
+		self.assertEqual(sorted(msgid for msgid, _userid in self.db.pop_recent_messages(CHAT, DIGEST)), [1, 3])
+		self.assertEqual(self.db.pop_user_messages(OTHER_CHAT, 101), [9])
+
+
+class SQLiteDBTests(BackendTests, unittest.TestCase):
+	def setUp(self):
+		self.db = SQLiteDB(':memory:', CHAT)
+
+
+@unittest.skipIf(not HAVE_FAKEREDIS, 'needs fakeredis and redis')
+class RedisDBTests(BackendTests, unittest.TestCase):
+	def setUp(self):
+		self.server = fakeredis.FakeServer()
+		self.db = self.instance()
+
+	def instance(self) -> 'RedisDB':
+		db = RedisDB('redis://localhost', 'test:')
+		db.r = fakeredis.FakeRedis(server=self.server)
+		return db
+
+	def test_vote_during_expiry_check(self):
+		'''
+		A vote from another instance between checking and deleting keeps the messages
+		'''
+		other = self.instance()
+		self.db.add_vk_messages(CHAT, 9, [1])
+		multi = redis.client.Pipeline.multi
+		voted = False
+
+		def vote_first(pipe):
+			nonlocal voted
+			if not voted:
+				voted = True
+				other.add_votekick(CHAT, 7, 9)
+			return multi(pipe)
+
+		with mock.patch.object(redis.client.Pipeline, 'multi', vote_first):
+			self.assertEqual(self.db.pop_expired_messages(), {})
+		self.assertTrue(voted)
+		self.assertEqual(self.db.pop_vk_messages(CHAT, 9), [1])
+
+
+if __name__ == '__main__':
+	unittest.main()